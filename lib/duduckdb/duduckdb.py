@@ -2,30 +2,68 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import io
 import logging
+import math
 from datetime import datetime
 import time
 import pwd
 import duckdb
 
 
-def get_headers(fn):
+def get_headers(fn, conn=duckdb):
     '''Extract the names and types of the columns in a database'''
-    columns = duckdb.sql(f"describe select * from '{fn}';").fetchall()
+    columns = conn.execute("select column_name, column_type from "
+                           "(describe select * from read_parquet(?));",
+                           [fn]).fetchall()
     labels = [c[0] for c in columns]
     types = [c[1] for c in columns]
     return labels, types
 
 
-def get_metadata(fn):
+def get_metadata(fn, conn=duckdb):
     '''Extract key-value metadata as dictionary'''
-    kvs = duckdb.sql(f"select * from parquet_kv_metadata('{fn}');").fetchall()
+    kvs = conn.execute("select key, value from parquet_kv_metadata(?);",
+                       [fn]).fetchall()
     metadata = {}
-    for _, key, value in kvs:
+    for key, value in kvs:
         metadata[key.decode("utf-8")] = value.decode("utf-8")
     return metadata
 
 
+def metric_aggregate(metric):
+    '''Return the aggregate computing a metric over the selected entries'''
+    if metric == 'size':
+        return 'sum(size)'
+    elif metric == 'inodes':
+        return 'count(size)'
+    raise NotImplementedError(f'Unknown metric {metric}')
+
+
+def path_depth(path):
+    '''Return the depth of a path, as stored in the raw_depth column'''
+    return path.count('/')
+
+
+def _prefix_range(prefix):
+    '''Return the half-open range of strings starting with a prefix'''
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def subtree_rule(directory, name='directory'):
+    '''Return a condition selecting a directory and everything below it,
+    together with the values of its named parameters'''
+    # Root directory has to be treated in a special way
+    if directory in ['.', '']:
+        return 'true', {}
+    # A range comparison allows duckdb to prune row groups using min/max
+    # statistics, which is not possible for pattern matching
+    lo, hi = _prefix_range(directory + '/')
+    rule = f"(path = ${name} or (path >= ${name}_lo and path < ${name}_hi))"
+    return rule, {name: directory, f'{name}_lo': lo, f'{name}_hi': hi}
+
+
 def sizeof_fmt(num, si_units=False, suffix="B", formatter='.1f'):
     '''Return a human-readable string representing a number of bytes'''
     if si_units:
@@ -34,15 +72,20 @@ def sizeof_fmt(num, si_units=False, suffix="B", formatter='.1f'):
     else:
         fac = 2.0**10
         units = ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei"]
-    for unit in units:
-        if abs(num) < fac:
-            return f"{num:{formatter}}{unit}{suffix}"
-        num /= fac
-    return f"{num:{formatter}}{units[-1]}{suffix}"
+    # Determine the unit from the logarithm rather than by repeated division
+    exp = 0
+    if num != 0:
+        exp = min(max(int(math.log(abs(num), fac)), 0), len(units) - 1)
+        # Correct for rounding errors in the logarithm
+        if exp > 0 and abs(num) < fac**exp:
+            exp -= 1
+        elif exp < len(units) - 1 and abs(num) >= fac**(exp + 1):
+            exp += 1
+    return f"{num / fac**exp:{formatter}}{units[exp]}{suffix}"
 
 
 def print_usage_single(sizes, identifier, human_readable=False, si_units=False,
-                       suffixes=["B"], prefix="", formatter='.1f'):
+                       suffixes=["B"], prefix="", formatter='.1f', file=None):
     if human_readable:
         assert len(sizes) == len(suffixes)
     msg = f'{prefix+identifier+":":24}'
@@ -56,43 +99,71 @@ def print_usage_single(sizes, identifier, human_readable=False, si_units=False,
             else:
                 sizestr = f'{size}'
         msg += f' {sizestr:16}'
-    print(msg)
+    print(msg, file=file)
+
+
+# Columns of the parquet file that can be used in a report
+COLUMNS = ['path', 'is_dir', 'size', 'uid', 'atime', 'mtime', 'ctime']
 
 
 class DUDB(object):
-    def __init__(self, fn, debug=False, nthreads=4):
+    def __init__(self, fn, debug=False, nthreads=4, columns=COLUMNS):
         self.fn = fn
         self.debug = debug
         self.nthreads = nthreads
-        self.read_db(self.fn)
+        self._uid_names = {}
+        self.read_db(self.fn, columns=columns)
+
+    def read_db(self, fn, columns=COLUMNS):
+        # Set up an in-memory connection, the object cache keeps the parquet
+        # metadata around for subsequent reads of the file
+        self.conn = duckdb.connect(database=":memory:",
+                                   config={'threads': self.nthreads,
+                                           'enable_object_cache': True})
+        if self.debug:
+            self.conn.execute("set enable_progress_bar = true;")
 
-    def read_db(self, fn):
         # Report age of parquet file
-        metadata = get_metadata(fn)
+        metadata = get_metadata(fn, conn=self.conn)
         if 'timestamp' in metadata.keys():
             timestamp = metadata['timestamp'].split('m=')[0]
             logging.warning(f'The data was collected on {timestamp}')
         else:
-            mtime = time.ctime(os.path.getmtime(fn))
-            mtime_str = datetime.strptime(mtime, "%a %b %d %H:%M:%S %Y")
+            mtime_str = datetime.fromtimestamp(int(os.path.getmtime(fn)))
             logging.warning(f'The file {fn} was last modified on {mtime_str}')
         logging.warning('The reported usage is a snapshot of the usage around '
                         'that time')
 
-        # Set up an in-memory connection and initialise it with parquet file
-        # content
-        self.conn = duckdb.connect(database=":memory:",
-                                   config={'threads': self.nthreads})
-        if self.debug:
-            self.conn.execute("set enable_progress_bar = true;")
+        # Initialise the connection with parquet file content
+        self.load_table(fn, columns)
 
-        logging.debug('Creating database in memory...')
+    def load_table(self, fn, columns):
+        # Only the requested columns that are present in the parquet file are
+        # loaded, reading the other columns would only cost time and memory
+        self._requested_columns = list(columns)
+        logging.debug('Creating database in memory with columns '
+                      f"{', '.join(columns)}...")
         tstart = time.time()
-        columns = '*'
-        self.conn.execute(f"create table index as select {columns} from "
-                          f"'{fn}';")
+        # Add a column representing filesystem depth by counting "/"
+        selection = ("columns(c -> list_contains($columns, c)), "
+                     "(len(path) - len(replace(path, '/', '')))::integer "
+                     "as raw_depth")
+        # Sorting by path keeps subtrees contiguous, so the min/max statistics
+        # of each row group allow duckdb to skip most of the table when
+        # selecting a range of paths
+        self.conn.execute("create or replace table index as select "
+                          f"{selection} from read_parquet($fn) order by path;",
+                          {'columns': self._requested_columns, 'fn': fn})
         logging.debug(f'... done, took {time.time() - tstart:.3f}s')
 
+        # Keep the loaded columns around to validate reports, the schema of
+        # the table is known without opening the parquet file again
+        self.conn.execute("select name, type from pragma_table_info('index') "
+                          "where name != 'raw_depth';")
+        columns = self.conn.fetchall()
+        self.columns = [c[0] for c in columns]
+        self._types = [c[1] for c in columns]
+
     def report_du(self, top_directory="", per_user=False, older_than=None,
                   newer_than=None, max_depth=1, min_depth=0, metrics=['size'],
                   human_readable=False, si_units=False,
@@ -106,85 +177,31 @@ class DUDB(object):
             assert timestamp_type, 'timestamp_type is required if ' \
                                    'older/newer_than is provided'
             required_columns.append(timestamp_type)
-        labels, types = get_headers(self.fn)
-        logging.debug(f"Found columns with labels {', '.join(labels)}")
+        # Reload the database if a required column was not requested before
+        missing_columns = [c for c in required_columns
+                           if c not in self._requested_columns]
+        if missing_columns:
+            self.load_table(self.fn,
+                            self._requested_columns + missing_columns)
+        logging.debug(f"Found columns with labels {', '.join(self.columns)}")
         for label in required_columns:
-            assert label in labels, f'Required column {label} is missing.'
+            assert label in self.columns, \
+                f'Required column {label} is missing.'
 
-        # Add a column representing filesystem depth by counting "/"
+        # Filesystem depth relative to the top directory
         top_directory_stripped = top_directory.rstrip(os.sep)
-        top_directory_depth = top_directory_stripped.count(os.sep)
-        if top_directory_stripped == "":
+        top_directory_depth = path_depth(top_directory_stripped)
+        if top_directory_stripped in ['.', '']:
             top_directory_depth -= 1
-        self.conn.execute("alter table index add if not exists depth "
-                          "integer;")
-        self.conn.execute("update index set depth = "
-                          "len(path) - len(replace(path, '/', '')) "
-                          f"- {top_directory_depth};")
+        depth_expr = "raw_depth - $top_directory_depth"
         # Special case of root directory
-        if top_directory_stripped == "":
-            query = "update index set depth = 0 where path = '.' or path = '';"
-            self.conn.execute(query)
+        if top_directory_stripped in ['.', '']:
+            depth_expr = ("case when path in ('.', '') then 0 "
+                          f"else {depth_expr} end")
 
-        # Print column headers
+        columns = ['path', 'user', 'depth'] + metrics
+        order_by = []
         if not suppress_output:
-            print_usage_single(metrics, "directory",
-                               suffixes=[""] * len(metrics))
-            print('=' * 80)
-
-        results = []
-        for depth in range(min_depth, max_depth+1):
-            # Select all directories of current depth
-            if top_directory_stripped == '':
-                top_directory_rule = 'true'
-            else:
-                pattern = f'^{top_directory_stripped}(/.*)?$'
-                top_directory_rule = f"regexp_full_match(path, '{pattern}')"
-
-            self.conn.execute(f"select path from index where depth = {depth} "
-                              f"and is_dir = 1 and {top_directory_rule};")
-            subdirectories = [dn[0] for dn in self.conn.fetchall()]
-            logging.debug(f'Found {len(subdirectories)} directories at level '
-                          f'{depth}')
-
-            for basedir in subdirectories:
-                # Root directory has to be treated in a special way
-                if basedir == '.':
-                    basedir_rule = 'true'
-                else:
-                    pattern = f'^{basedir}(/.*)?$'
-                    basedir_rule = f"regexp_full_match(path, '{pattern}')"
-
-                sizes = self.query_metrics(
-                        metrics, basedir_rule, older_than=older_than,
-                        newer_than=newer_than, timestamp_type=timestamp_type,
-                    )
-                results.append([basedir, 'ALL', depth] + sizes)
-
-                # Print usage for each user separately
-                if per_user:
-                    self.conn.execute("select distinct uid from index where "
-                                      f"{basedir_rule};")
-                    uids = [uid[0] for uid in self.conn.fetchall()]
-                    uids_str = ",".join([f'{uid}' for uid in uids])
-                    logging.debug(f'Users with files inside {basedir}: '
-                                  f'{uids_str}')
-                    for uid in uids:
-                        sizes = self.query_metrics(
-                            metrics, basedir_rule, older_than=older_than,
-                            newer_than=newer_than, uid=uid,
-                            timestamp_type=timestamp_type
-                        )
-                        try:
-                            username = pwd.getpwuid(uid).pw_name
-                        except KeyError:
-                            logging.warning(f'Failed to look up uid {uid}')
-                            username = str(uid)
-                        results.append([basedir, username, depth] + sizes)
-        if not suppress_output:
-            suffixes = ["" if m == "inodes" else "B" for m in metrics]
-            columns = ['path', 'user', 'depth'] + metrics
-
             # Some sanity checks befor sorting
             if 'user' in sort_by:
                 assert per_user, ('When sorting by user, '
@@ -197,9 +214,54 @@ class DUDB(object):
             elif per_user:
                 assert 'depth' in sort_by, \
                     'When reporting per user, sorting has to include depth'
+            # Usernames are not known to duckdb, sorting by user is done
+            # afterwards
+            if 'user' not in sort_by:
+                order_by = self.sort_terms(columns, sort_by)
+
+        # Enumerate all directories between min_depth and max_depth and
+        # aggregate the usage below them in a single query
+        top_directory_rule, top_directory_params = \
+            subtree_rule(top_directory_stripped)
+        rows = self.query_report(
+            metrics, min_depth, max_depth, depth_expr, top_directory_depth,
+            top_directory_rule, path_params=top_directory_params,
+            per_user=per_user,
+            older_than=older_than, newer_than=newer_than,
+            timestamp_type=timestamp_type, order_by=order_by,
+        )
+        logging.debug(f'Found {len(rows)} entries between level {min_depth} '
+                      f'and {max_depth}')
+        if per_user:
+            # The users per directory follow from the grouping in the query,
+            # there is no need to look them up separately
+            uids = dict.fromkeys(row[1] for row in rows if not row[2])
+            uids_str = ",".join([f'{uid}' for uid in uids])
+            logging.debug('Users with files inside '
+                          f'{top_directory_stripped or "."}: {uids_str}')
+
+        results = []
+        for basedir, uid, all_users, depth, *sizes in rows:
+            if all_users:
+                results.append([basedir, 'ALL', depth] + sizes)
+                continue
 
-            # Sort the obtained results
-            results = self.sort_list(results, columns, sort_by)
+            # Print usage for each user separately
+            username = self.get_username(uid)
+            results.append([basedir, username, depth] + sizes)
+
+        if not suppress_output:
+            suffixes = ["" if m == "inodes" else "B" for m in metrics]
+            if 'user' in sort_by:
+                results = self.sort_list(results, columns, sort_by)
+
+            # Collect the output and write it at once
+            out = io.StringIO()
+
+            # Print column headers
+            print_usage_single(metrics, "directory",
+                               suffixes=[""] * len(metrics), file=out)
+            print('=' * 80, file=out)
 
             for res in results:
                 basedir = res[0]
@@ -210,13 +272,24 @@ class DUDB(object):
                     sizes, basedir if username == 'ALL' else username,
                     human_readable=human_readable, si_units=si_units,
                     prefix=" " * (0 if username == 'ALL' else 4),
-                    suffixes=suffixes
+                    suffixes=suffixes, file=out
                 )
                 if per_user and username == 'ALL':
-                    print('-' * 80)
+                    print('-' * 80, file=out)
+            sys.stdout.write(out.getvalue())
 
         return results
 
+    def get_username(self, uid):
+        '''Look up the name of a user, caching the result'''
+        if uid not in self._uid_names:
+            try:
+                self._uid_names[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                logging.warning(f'Failed to look up uid {uid}')
+                self._uid_names[uid] = str(uid)
+        return self._uid_names[uid]
+
     def sort_list(self, results, columns, sortby):
         """
         Sorts a list of result tuples based on specified columns and sort
@@ -236,86 +309,108 @@ class DUDB(object):
         - AssertionError: If a column in sortby is not found in columns.
         """
 
-        class Sorter:
-            """A helper class to define sorting logic based on column indices
-               and comparator classes."""
-
-            def __init__(self, columns, sortby):
-                self.keys = []
-                for ikey, key in enumerate(sortby):
-                    # Ensure the sort key exists in the columns
-                    assert key in columns, \
-                        (f"Impossible to sort by {key}, "
-                         f"it is not in the columns {columns}")
-
-                    # Determine the comparator class based on the column type
-                    if key in ['size', 'inodes']:
-                        # Reverse sorting for 'size' and 'inodes'
-                        self.keys.append((columns.index(key), reversor))
-                    else:
-                        # Normal sorting for other columns
-                        self.keys.append((columns.index(key), versor))
-
-            def sort(self, res):
-                """Creates a list of comparator objects for sorting."""
-                return [cls(res[ikey]) for ikey, cls in self.keys]
-
-        class comparator:
-            """Base comparator class to define equality comparison based on
-            the wrapped object."""
-
-            def __init__(self, obj):
-                self.obj = obj
-
-            def __eq__(self, other):
-                return other.obj == self.obj
-
-        class reversor(comparator):
-            """Comparator class for reverse sorting."""
-            def __lt__(self, other):
-                return other.obj < self.obj  # Reversed comparison logic
-
-        class versor(comparator):
-            """Comparator class for normal sorting."""
-            def __lt__(self, other):
-                return other.obj > self.obj  # Normal comparison logic
-
-        # Instantiate a Sorter object with the specified columns and sort order
-        sorter = Sorter(columns, sortby)
-
-        # Sort the list using the Sorter object's sort method as the key
-        sorted_list = sorted(results, key=sorter.sort)
+        keys = []
+        for key in sortby:
+            # Ensure the sort key exists in the columns
+            assert key in columns, \
+                (f"Impossible to sort by {key}, "
+                 f"it is not in the columns {columns}")
+            # Reverse sorting for 'size' and 'inodes'
+            keys.append((columns.index(key), key in ['size', 'inodes']))
+
+        def sort_key(res):
+            """Creates a tuple of values, negating the reversed ones."""
+            return tuple(-res[ikey] if reverse else res[ikey]
+                         for ikey, reverse in keys)
+
+        # Sort the list using plain tuple comparison of the keys
+        sorted_list = sorted(results, key=sort_key)
         return sorted_list
 
-    def query_metrics(self, metrics, path_rule, older_than=None,
-                      newer_than=None, uid=None, timestamp_type=None):
-        sizes = []
-        for metric in metrics:
-            if metric == 'size':
-                qmetric = 'sum'
-            elif metric == 'inodes':
-                qmetric = 'count'
+    def sort_terms(self, columns, sortby):
+        '''Translate the columns to sort by into order by terms'''
+        terms = []
+        for key in sortby:
+            # Ensure the sort key exists in the columns
+            assert key in columns, \
+                (f"Impossible to sort by {key}, "
+                 f"it is not in the columns {columns}")
+            if key == 'path':
+                terms.append('dir')
+            elif key == 'depth':
+                terms.append('depth')
+            elif key in ['size', 'inodes']:
+                # Reverse sorting for 'size' and 'inodes', the metrics
+                # follow the path, user and depth columns
+                terms.append(f'm{columns[3:].index(key)} desc')
             else:
-                raise NotImplementedError(f'Unknown metric {metric}')
-
-            # Print usage for this directory
-            query = f"select {qmetric}(size) from index where {path_rule}"
-
-            # Filter based on timestamp
-            if older_than:
-                query += f" and {timestamp_type} < '{older_than}'"
-            if newer_than:
-                query += f" and {timestamp_type} > '{newer_than}'"
-
-            # Filter based on user
-            if uid is not None:
-                query += f' and uid = {uid};'
-
-            # Get value
-            self.conn.execute(query)
-            result = self.conn.fetchone()[0]
-            # When nothing is found, this should be interpreted as 0
-            if result is None:
-                result = 0
-            sizes.append(result)
-        return sizes
+                raise NotImplementedError(f'Cannot sort by {key} in duckdb')
+        return terms
+
+    def query_report(self, metrics, min_depth, max_depth, depth_expr,
+                     top_directory_depth, path_rule, path_params={},
+                     per_user=False,
+                     older_than=None, newer_than=None, timestamp_type=None,
+                     order_by=[]):
+        # Every entry is attributed to its ancestor at each depth it is
+        # part of, consisting of the first components of its path. The root
+        # directory has no components. Older duckdb versions join an empty
+        # list into null rather than an empty string
+        nparts = "level + $top_directory_depth + 1"
+        ancestor = ("coalesce(array_to_string(string_split(path, '/')"
+                    f"[1:{nparts}], '/'), '')")
+        levels = (f"unnest(range($min_depth, least({depth_expr}, "
+                  "$max_depth) + 1)) as level")
+
+        # Filter based on timestamp, this is applied to the aggregates only so
+        # that users without matching files are still reported. Without
+        # metrics there are no aggregates, and the timestamps must not be
+        # bound
+        params = {'min_depth': min_depth, 'max_depth': max_depth,
+                  'top_directory_depth': top_directory_depth, **path_params}
+        time_rules = []
+        if older_than and metrics:
+            time_rules.append(f"{timestamp_type} < $older_than")
+            params['older_than'] = older_than
+        if newer_than and metrics:
+            time_rules.append(f"{timestamp_type} > $newer_than")
+            params['newer_than'] = newer_than
+        time_filter = ''
+        if time_rules:
+            time_filter = f" filter (where {' and '.join(time_rules)})"
+
+        aggregates = []
+        for imetric, metric in enumerate(metrics):
+            aggregates.append(f"{metric_aggregate(metric)}{time_filter} "
+                              f"as m{imetric}")
+        # When nothing is found, this should be interpreted as 0
+        sizes = [f"coalesce(m{imetric}, 0)" for imetric in range(len(metrics))]
+
+        # Group by user as well, the rows with grouping(uid) = 1 contain the
+        # totals over all users
+        if per_user:
+            groups = ("grouping sets ((level, ancestor), "
+                      "(level, ancestor, uid))")
+            users = "uid, grouping(uid) as all_users"
+        else:
+            groups = "level, ancestor"
+            users = "null as uid, 1 as all_users"
+
+        # Ties are resolved by the order of the directories and users
+        order_by = order_by + ['depth', 'dir', 'all_users desc', 'uid']
+
+        # Join the directories with the usage of their subtree at the same
+        # depth, the root directory has to be treated in a special way
+        query = (f"with dirs as (select path as dir, {depth_expr} as "
+                 "dir_depth from index where dir_depth between $min_depth "
+                 f"and $max_depth and is_dir = 1 and {path_rule}), "
+                 f"usage as (select level, {ancestor} as ancestor, {users}, "
+                 f"{', '.join(aggregates)} from (select *, {levels} "
+                 f"from index where {path_rule}) group by {groups}) "
+                 "select dir, uid, coalesce(all_users, 1) as all_users, "
+                 f"dir_depth as depth, {', '.join(sizes)} from dirs "
+                 "left join usage on level = dir_depth and ancestor = "
+                 "case when dir in ('.', '') then '' else dir end "
+                 f"order by {', '.join(order_by)};")
+        self.conn.execute(query, params)
+        return self.conn.fetchall()